@@ -38,34 +38,109 @@ defined for a message:
  * text - the text content of the message (can be included via iframe)
  * send_test - send a test of the message.
  * send_now - send the message now.
+ * recipients - paginated list of the recipients of a message (used from send_now)
  * import - import/remove a list of recipients
+ * export - download the message log as CSV (optionally gzip compressed)
 """
 
+import calendar
+import csv
+import hashlib
+import zlib
+
+from django.conf import settings
 from django.conf.urls import url
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.urls import reverse
 from django.db.utils import IntegrityError
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
-from django.utils.encoding import force_text
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import http_date, quote_etag
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from djangoplicity.mailer.forms import MessageForm
-from djangoplicity.mailer.models import Message, MessageLog, Recipient
+from djangoplicity.mailer.models import Link, Message, MessageLog, Recipient, RecipientHistory
+
+# Number of seconds a rendered HTML/text preview is kept in the cache.
+PREVIEW_CACHE_TIMEOUT = getattr( settings, 'MAILER_PREVIEW_CACHE_TIMEOUT', 3600 )
+
+# Number of email addresses shown per page in the recipients view.
+RECIPIENTS_PER_PAGE = 500
+
+
+def _get_preview( pk, field, last_modified ):
+    """
+    Get the content of a message field for the preview views together with
+    its ETag. The result is cached by message id and modification time, so
+    saving a message automatically invalidates its previews.
+    """
+    key = 'mailer_preview_%s_%s_%s' % ( pk, field, last_modified.strftime( '%Y%m%d%H%M%S%f' ) )
+    preview = cache.get( key )
+
+    if preview is None:
+        content = Message.objects.filter( pk=pk ).values_list( field, flat=True ).first() or ''
+        etag = hashlib.md5( force_bytes( content ) ).hexdigest()
+        preview = ( etag, content )
+        cache.set( key, preview, PREVIEW_CACHE_TIMEOUT )
+
+    return preview
+
+
+class _Echo( object ):
+    """
+    File-like object which returns the written value, for use with csv.writer.
+    """
+    def write( self, value ):
+        return value
+
+
+def _csv_lines( header, rows, batch_size=1000 ):
+    """
+    Generate the CSV lines for an iterable of rows, in chunks of batch_size rows.
+    """
+    writer = csv.writer( _Echo() )
+    yield writer.writerow( header )
+
+    lines = []
+    for row in rows:
+        lines.append( writer.writerow( row ) )
+        if len( lines ) >= batch_size:
+            yield ''.join( lines )
+            lines = []
+
+    if lines:
+        yield ''.join( lines )
+
+
+def _gzip_chunks( chunks ):
+    """
+    Gzip compress an iterable of text chunks.
+    """
+    compressor = zlib.compressobj( 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS )
+    for chunk in chunks:
+        data = compressor.compress( force_bytes( chunk ) )
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 class MessageAdmin( admin.ModelAdmin ):
-    list_display = [ 'subject', 'from_name', 'from_email', 'type', 'queued', 'sent', 'delivered', 'messages_delivered', 'messages_failed' ]
-    list_filter = ['type', 'sent', 'delivered', 'created', 'last_modified']
+    list_display = [ 'subject', 'from_name', 'from_email', 'type', 'status', 'delivered', 'messages_delivered', 'messages_failed' ]
+    list_filter = ['type', 'status', 'sent', 'delivered', 'created', 'last_modified']
 
     search_fields = ['from_name', 'from_email', 'reply_to', 'subject', 'plain_text', 'html_text']
-    readonly_fields = ['queued', 'sent', 'delivered', 'created', 'last_modified', 'messages_delivered', 'messages_failed', 'get_recipients_count']
+    readonly_fields = ['status', 'queued', 'sent', 'delivered', 'created', 'last_modified', 'messages_delivered', 'messages_failed', 'opens', 'clicks', 'get_recipients_count']
     filter_horizontal = ['contact_groups']
 
     fieldsets = (
         (
             None,
             {
-                'fields': ( 'queued', 'sent', 'delivered', 'get_recipients_count',),
+                'fields': ( 'status', 'queued', 'sent', 'delivered', 'get_recipients_count',),
             }
         ),
         (
@@ -80,6 +155,12 @@ class MessageAdmin( admin.ModelAdmin ):
                 'fields': ( 'contact_groups', ),
             }
         ),
+        (
+            "Frequency cap",
+            {
+                'fields': ( 'frequency_cap_messages', 'frequency_cap_days' ),
+            }
+        ),
         (
             "Content",
             {
@@ -89,7 +170,7 @@ class MessageAdmin( admin.ModelAdmin ):
         (
             "Status",
             {
-                'fields': ( 'messages_delivered', 'messages_failed', 'created', 'last_modified', ),
+                'fields': ( 'messages_delivered', 'messages_failed', 'opens', 'clicks', 'created', 'last_modified', ),
             }
         ),
     )
@@ -102,7 +183,9 @@ class MessageAdmin( admin.ModelAdmin ):
             url(r'^(?P<pk>[0-9]+)/text/$', self.admin_site.admin_view(self.text_view), name='mailer_text'),
             url(r'^(?P<pk>[0-9]+)/send_test/$', self.admin_site.admin_view(self.send_test_view), name='mailer_send_test'),
             url(r'^(?P<pk>[0-9]+)/send_now/$', self.admin_site.admin_view(self.send_now_view), name='mailer_send_now'),
+            url(r'^(?P<pk>[0-9]+)/recipients/$', self.admin_site.admin_view(self.recipients_view), name='mailer_recipients'),
             url(r'^(?P<pk>[0-9]+)/import/$', self.admin_site.admin_view(self.import_view), name='mailer_import'),
+            url(r'^(?P<pk>[0-9]+)/export/$', self.admin_site.admin_view(self.export_view), name='mailer_export'),
         ]
         return extra_urls + urls
 
@@ -110,21 +193,41 @@ class MessageAdmin( admin.ModelAdmin ):
         """
         View HTML version of message
         """
-        msg = get_object_or_404( Message, pk=pk )
-
-        if not msg.is_html():
-            raise Http404
-
-        return HttpResponse( msg.html_text, content_type="text/html" )
+        return self._preview_view( request, pk, 'html_text', "text/html; charset=utf-8" )
 
     def text_view( self, request, pk=None ):
         """
         View text version of message
         """
-        msg = get_object_or_404( Message, pk=pk )
-        response = HttpResponse( msg.plain_text )
-        response["Content-Type"] = "text/plain; charset=utf-8"
-        return response
+        return self._preview_view( request, pk, 'plain_text', "text/plain; charset=utf-8" )
+
+    def _preview_view( self, request, pk, field, content_type ):
+        """
+        Helper function for the HTML/text views. Only the modification time of
+        the message is loaded from the database for each request - the body
+        is taken from the preview cache, and a 304 response is returned if
+        the browser already has the current version.
+        """
+        try:
+            last_modified, msg_type = Message.objects.values_list( 'last_modified', 'type' ).get( pk=pk )
+        except Message.DoesNotExist:
+            raise Http404
+
+        if field == 'html_text' and msg_type != 'H':
+            raise Http404
+
+        etag, content = _get_preview( pk, field, last_modified )
+        etag = quote_etag( etag )
+        if timezone.is_naive( last_modified ):
+            last_modified = timezone.make_aware( last_modified )
+        timestamp = calendar.timegm( last_modified.utctimetuple() )
+
+        response = HttpResponse( content, content_type=content_type )
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date( timestamp )
+        patch_cache_control( response, private=True, max_age=0, must_revalidate=True )
+
+        return get_conditional_response( request, etag=etag, last_modified=timestamp, response=response )
 
     def send_test_view( self, request, pk=None ):
         """
@@ -169,8 +272,10 @@ class MessageAdmin( admin.ModelAdmin ):
             if form.is_valid():
                 send_now = form.cleaned_data['send_now']
                 if send_now:
-                    msg.send_now()
-                    self.message_user( request, _( "Message %s has been added to the send queue" % msg.pk ) )
+                    if msg.send_now():
+                        self.message_user( request, _( "Message %s has been added to the send queue" % msg.pk ) )
+                    else:
+                        self.message_user( request, _( "Message %s have already been sent or is in the queue for being sent." % msg.pk ), level=messages.ERROR )
                     return HttpResponseRedirect( reverse( "%s:mailer_message_change" % self.admin_site.name, args=[msg.pk] ) )
 
             if 'send_now' not in form.errors:
@@ -183,11 +288,47 @@ class MessageAdmin( admin.ModelAdmin ):
             'title': _( '%s: Send now' ) % force_text( self.model._meta.verbose_name ).title(),
             'adminform': form,
             'original': msg,
-            'groups': msg.get_contact_groups_recipients(),
+            'recipients_count': msg.recipient_set.count(),
+            'groups': msg.get_contact_groups_counts(),
         }
 
         return self._render_admin_view( request, "admin/mailer/message/send_now_form.html", ctx )
 
+    def recipients_view( self, request, pk=None ):
+        """
+        Paginated list of recipients for a message. If the "group" parameter
+        is given, the recipients from the given contact group are listed,
+        otherwise the recipients defined directly for the message.
+        """
+        msg = get_object_or_404( Message, pk=pk )
+
+        group = None
+        if request.GET.get( 'group' ):
+            try:
+                group = get_object_or_404( msg.contact_groups.all(), pk=int( request.GET['group'] ) )
+            except ValueError:
+                raise Http404
+            emails = Message.get_group_contacts( group ).order_by( 'email' ).values_list( 'email', flat=True )
+        else:
+            emails = msg.recipient_set.order_by( 'to_email' ).values_list( 'to_email', flat=True )
+
+        paginator = Paginator( emails, RECIPIENTS_PER_PAGE )
+        try:
+            page = paginator.page( request.GET.get( 'page', 1 ) )
+        except PageNotAnInteger:
+            page = paginator.page( 1 )
+        except EmptyPage:
+            page = paginator.page( paginator.num_pages )
+
+        ctx = {
+            'title': _( '%s: Recipients' ) % force_text( self.model._meta.verbose_name ).title(),
+            'original': msg,
+            'group': group,
+            'page': page,
+        }
+
+        return self._render_admin_view( request, "admin/mailer/message/recipients_list.html", ctx )
+
     def import_view( self, request, pk=None ):
         """
         Import list of recipients
@@ -202,6 +343,11 @@ class MessageAdmin( admin.ModelAdmin ):
                 emails = form.cleaned_data['recipients']
                 remove = form.cleaned_data['remove']
 
+                if form.cleaned_data['replace']:
+                    added, kept, removed = msg.sync_recipients( emails )
+                    self.message_user( request, _( "Recipients replaced (%s new, %s kept, %s removed)." ) % ( added, kept, removed ) )
+                    return HttpResponseRedirect( reverse( "%s:mailer_message_change" % self.admin_site.name, args=[msg.pk] ) )
+
                 failed = 0
                 success = 0
 
@@ -233,6 +379,27 @@ class MessageAdmin( admin.ModelAdmin ):
 
         return self._render_admin_view( request, "admin/mailer/message/import_form.html", ctx )
 
+    def export_view( self, request, pk=None ):
+        """
+        Export the message log as CSV. The rows are streamed to the client
+        as they are read from the database. Add "?gzip=1" to get a gzip
+        compressed file.
+        """
+        msg = get_object_or_404( Message, pk=pk )
+
+        rows = MessageLog.objects.filter( message=msg ).order_by( 'pk' ).values_list( 'timestamp', 'recipient', 'success', 'bounced', 'relay' ).iterator()
+        content = _csv_lines( ['timestamp', 'recipient', 'success', 'bounced', 'relay'], rows )
+
+        if request.GET.get( 'gzip' ):
+            response = StreamingHttpResponse( _gzip_chunks( content ), content_type='application/gzip' )
+            filename = 'message-%s-log.csv.gz' % msg.pk
+        else:
+            response = StreamingHttpResponse( content, content_type='text/csv; charset=utf-8' )
+            filename = 'message-%s-log.csv' % msg.pk
+
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
     def _render_admin_view( self, request, template, context ):
         """
         Helper function for rendering an admin view
@@ -249,10 +416,10 @@ class MessageAdmin( admin.ModelAdmin ):
 
 
 class MessageLogAdmin( admin.ModelAdmin ):
-    list_display = [ 'timestamp', 'message', 'recipient', 'success', ]
-    list_filter = [ 'timestamp', 'success', ]
+    list_display = [ 'timestamp', 'message', 'recipient', 'success', 'bounced', 'relay', ]
+    list_filter = [ 'timestamp', 'success', 'bounced', 'relay', ]
     search_fields = ['message__subject', 'recipient', ]
-    readonly_fields = ['timestamp', 'message', 'recipient', 'success', ]
+    readonly_fields = ['timestamp', 'message', 'recipient', 'success', 'bounced', 'relay', ]
 
     def has_add_permission( self, request ):
         return False
@@ -264,6 +431,24 @@ class MessageLogAdmin( admin.ModelAdmin ):
         return False
 
 
+class LinkAdmin( admin.ModelAdmin ):
+    list_display = [ 'url', 'message', 'clicks', ]
+    search_fields = ['url', 'message__subject', ]
+    readonly_fields = ['message', 'url', 'clicks', ]
+
+    def has_add_permission( self, request ):
+        return False
+
+
+class RecipientHistoryAdmin( admin.ModelAdmin ):
+    list_display = [ 'recipient', 'last_sent', ]
+    search_fields = ['recipient', ]
+    readonly_fields = ['recipient', 'last_sent', 'sends', ]
+
+    def has_add_permission( self, request ):
+        return False
+
+
 class RecipientAdmin( admin.ModelAdmin ):
     list_display = [ 'to_email', 'message', ]
     search_fields = ['to_email', 'message__subject', ]
@@ -276,3 +461,5 @@ def register_with_admin( admin_site ):
     admin_site.register( Message, MessageAdmin )
     admin_site.register( MessageLog, MessageLogAdmin )
     admin_site.register( Recipient, RecipientAdmin )
+    admin_site.register( Link, LinkAdmin )
+    admin_site.register( RecipientHistory, RecipientHistoryAdmin )
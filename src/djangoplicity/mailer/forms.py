@@ -118,8 +118,15 @@ class RecipientsForm( forms.Form ):
     test message to.
     """
     remove = forms.BooleanField( required=False, label=_( "Remove recipients?" ), help_text=_( "Check-mark this box to remove recipients instead of adding them." ), initial=False )
+    replace = forms.BooleanField( required=False, label=_( "Replace recipients?" ), help_text=_( "Check-mark this box to replace the entire recipients list with the given list." ), initial=False )
     recipients = EmailListField( help_text=_( "One email address per line" ) )
 
+    def clean( self ):
+        cleaned_data = super( RecipientsForm, self ).clean()
+        if cleaned_data.get( 'remove' ) and cleaned_data.get( 'replace' ):
+            raise ValidationError( _( "Recipients cannot be both removed and replaced." ) )
+        return cleaned_data
+
 
 class MessageForm(forms.ModelForm):
     html_text = forms.CharField(widget=AdminRichTextAreaWidget({'rows': '30'}), required=False)
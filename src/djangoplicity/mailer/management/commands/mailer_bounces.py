@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Process delivery status notifications (bounces) from a local mbox file or
+Maildir. Failed recipients are marked as bounced in the message log and
+optionally invalidated in the contacts database (by adding the "-invalid"
+suffix to their email address).
+
+The mailbox is read one message at a time, so arbitrarily large mailboxes
+can be processed::
+
+    python manage.py mailer_bounces /var/mail/bounces [--maildir] [--invalidate-contacts]
+"""
+
+import mailbox
+from email.parser import BytesFeedParser, HeaderParser
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Value
+from django.db.models.functions import Concat, Lower
+
+from djangoplicity.contacts.models import Contact, ContactGroup
+from djangoplicity.mailer.membership import invalidate_groups
+from djangoplicity.mailer.models import MESSAGE_HEADER, MessageLog
+
+
+def iter_mbox( path ):
+    """
+    Iterate over the messages in a mbox file, parsing one message at a time.
+    """
+    parser = None
+    with open( path, 'rb' ) as f:
+        for line in f:
+            if line.startswith( b'From ' ):
+                if parser is not None:
+                    yield parser.close()
+                parser = BytesFeedParser()
+            elif parser is not None:
+                parser.feed( line )
+    if parser is not None:
+        yield parser.close()
+
+
+def iter_maildir( path ):
+    """
+    Iterate over the messages in a Maildir, parsing one message at a time.
+    """
+    for msg in mailbox.Maildir( path, factory=None, create=False ).itervalues():
+        yield msg
+
+
+def _get_message_id( part ):
+    """
+    Get the mailer message id from the returned original message or headers.
+    """
+    if part.get_content_type() == 'message/rfc822':
+        payload = part.get_payload()
+        headers = payload[0] if payload else None
+    else:
+        headers = HeaderParser().parsestr( part.get_payload( decode=True ).decode( 'utf-8', 'replace' ) )
+
+    try:
+        return int( headers[MESSAGE_HEADER] )
+    except ( TypeError, ValueError ):
+        return None
+
+
+def parse_bounce( msg ):
+    """
+    Parse a delivery status notification (RFC 3464). Returns a tuple of the
+    mailer message id (or None if unknown) and the list of recipients for
+    which the delivery permanently failed.
+    """
+    msg_id = None
+    recipients = []
+
+    for part in msg.walk():
+        content_type = part.get_content_type()
+
+        if content_type == 'message/delivery-status':
+            # First block contains per-message fields, the rest per-recipient fields.
+            for block in part.get_payload()[1:]:
+                action = ( block.get( 'Action' ) or '' ).strip().lower()
+                status = ( block.get( 'Status' ) or '' ).strip()
+                recipient = block.get( 'Final-Recipient' ) or block.get( 'Original-Recipient' )
+                if action == 'failed' and status.startswith( '5' ) and recipient:
+                    recipient = recipient.split( ';', 1 )[-1].strip().strip( '<>' ).lower()
+                    if recipient:
+                        recipients.append( recipient )
+        elif content_type in ( 'message/rfc822', 'text/rfc822-headers' ) and msg_id is None:
+            msg_id = _get_message_id( part )
+
+    return msg_id, recipients
+
+
+class Command( BaseCommand ):
+    help = 'Process bounced messages from a mbox file or Maildir.'
+
+    def add_arguments( self, parser ):
+        parser.add_argument( 'path', help='Path to mbox file or Maildir.' )
+        parser.add_argument( '--maildir', action='store_true', help='Mailbox is a Maildir instead of a mbox file.' )
+        parser.add_argument( '--invalidate-contacts', action='store_true', help='Add the "-invalid" suffix to the email address of bounced contacts.' )
+        parser.add_argument( '--batch-size', type=int, default=1000, help='Number of bounces to collect before updating the database (default: 1000).' )
+
+    def handle( self, *args, **options ):
+        self.invalidate_contacts = options['invalidate_contacts']
+        batch_size = max( options['batch_size'], 1 )
+
+        try:
+            messages = iter_maildir( options['path'] ) if options['maildir'] else iter_mbox( options['path'] )
+
+            processed = 0
+            bounces = []
+            self.logs_updated = 0
+            self.contacts_updated = 0
+
+            for msg in messages:
+                processed += 1
+                msg_id, recipients = parse_bounce( msg )
+                bounces += [( msg_id, r ) for r in recipients]
+
+                if len( bounces ) >= batch_size:
+                    self._flush( bounces )
+                    bounces = []
+                    self.stdout.write( "%s messages processed" % processed )
+
+            self._flush( bounces )
+        except ( IOError, OSError, mailbox.Error ) as e:
+            raise CommandError( "Could not read mailbox %s: %s" % ( options['path'], e ) )
+
+        self.stdout.write( "%s messages processed: %s message log entries marked as bounced, %s contacts invalidated." % ( processed, self.logs_updated, self.contacts_updated ) )
+
+    def _flush( self, bounces ):
+        """
+        Update message logs and contacts for a batch of bounces.
+        """
+        if not bounces:
+            return
+
+        by_message = {}
+        for msg_id, recipient in bounces:
+            if msg_id is not None:
+                by_message.setdefault( msg_id, set() ).add( recipient )
+
+        for msg_id, recipients in by_message.items():
+            self.logs_updated += MessageLog.objects.filter( message_id=msg_id, recipient__in=recipients, bounced=False ).update( bounced=True )
+
+        if self.invalidate_contacts:
+            recipients = set( [r for _msg_id, r in bounces] )
+            pks = list( Contact.objects.annotate( email_lower=Lower( 'email' ) ).filter( email_lower__in=recipients ).values_list( 'pk', flat=True ) )
+            self.contacts_updated += Contact.objects.filter( pk__in=pks ).update( email=Concat( 'email', Value( '-invalid' ) ) )
+
+            # Bulk updates don't send signals, so the group cache must be invalidated explicitly.
+            invalidate_groups( set( ContactGroup.objects.filter( contact__pk__in=pks ).values_list( 'pk', flat=True ) ) )
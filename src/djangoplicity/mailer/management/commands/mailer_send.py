@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Send a message directly from the command line without using Celery. The
+recipients are split into chunks which are sent by a pool of worker
+processes, each with its own SMTP connection.
+
+Usage::
+
+    python manage.py mailer_send <message id> [--processes 4] [--chunk-size 100]
+"""
+
+import multiprocessing
+from multiprocessing.util import Finalize
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from djangoplicity.mailer.models import STATUS_DRAFT, STATUS_FAILED, STATUS_QUEUED, STATUS_SENDING, Message
+
+# Message, send key and SMTP connection used by a worker process.
+_message = None
+_send_key = None
+_connection = None
+
+
+def _close_connection():
+    try:
+        _connection.close()
+    except Exception:
+        pass
+
+
+def _init_worker( msg_id, send_key ):
+    """
+    Initialise a worker process. The message is loaded and the SMTP
+    connection opened by the first task, so errors are reported to the
+    parent process (an exception in a pool initializer makes the pool
+    respawn workers forever).
+    """
+    global _message, _send_key
+
+    _message = msg_id
+    _send_key = send_key
+
+
+def _send_chunk( recipients ):
+    """
+    Send the message to a chunk of recipients. Returns a tuple with the number
+    of succeeded and failed deliveries. The SMTP connection is kept open until
+    the process exits.
+    """
+    global _message, _connection
+
+    if not isinstance( _message, Message ):
+        _message = Message.objects.get( pk=_message )
+
+    if _connection is None:
+        connection = Message.get_connection()
+        connection.open()
+        _connection = connection
+        Finalize( None, _close_connection, exitpriority=16 )
+
+    return _message._send_emails( _connection, recipients, send_key=_send_key )
+
+
+class Command( BaseCommand ):
+    help = 'Send a message to all its recipients using a pool of worker processes (without Celery).'
+
+    def add_arguments( self, parser ):
+        parser.add_argument( 'msg_id', type=int, help='Id of the message to send.' )
+        parser.add_argument( '--processes', type=int, default=4, help='Number of worker processes (default: 4).' )
+        parser.add_argument( '--chunk-size', type=int, default=100, help='Number of recipients sent per task (default: 100).' )
+        parser.add_argument( '--resume', action='store_true', help='Join the current send run of a queued message (e.g. if the Celery broker is down), or resume an interrupted run.' )
+
+    def handle( self, *args, **options ):
+        try:
+            msg = Message.objects.get( pk=options['msg_id'] )
+        except Message.DoesNotExist:
+            raise CommandError( "Message %s does not exists." % options['msg_id'] )
+
+        if options['resume']:
+            send_key = msg.send_key if msg.status in ( STATUS_QUEUED, STATUS_SENDING ) else None
+        else:
+            send_key = msg._start_send( ( STATUS_DRAFT, STATUS_FAILED ) )
+
+        if not send_key or not msg._transition( ( STATUS_QUEUED, STATUS_SENDING ), STATUS_SENDING, key=send_key ):
+            raise CommandError( "Message %s have already been sent or is in the queue for being sent." % msg.pk )
+
+        processes = max( options['processes'], 1 )
+        chunk_size = max( options['chunk_size'], 1 )
+
+        recipients = sorted( msg.get_unsent_recipients() )
+        total = len( recipients )
+        chunks = [recipients[i:i + chunk_size] for i in range( 0, total, chunk_size )]
+
+        self.stdout.write( "Sending message %s to %s recipients using %s processes." % ( msg.pk, total, processes ) )
+
+        succeeded = 0
+        failed = 0
+
+        if chunks:
+            # Database connections cannot be shared with the forked processes.
+            connections.close_all()
+
+            pool = multiprocessing.Pool( processes, _init_worker, ( msg.pk, send_key ) )
+            try:
+                for chunk_succeeded, chunk_failed in pool.imap_unordered( _send_chunk, chunks ):
+                    succeeded += chunk_succeeded
+                    failed += chunk_failed
+                    self.stdout.write( "%s/%s sent (%s failed)" % ( succeeded + failed, total, failed ) )
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                msg._transition( ( STATUS_SENDING, ), STATUS_FAILED, key=send_key, queued=False )
+                raise
+            finally:
+                pool.join()
+
+        if not msg._set_delivered( send_key ):
+            raise CommandError( "Message %s send run was stopped - the message has been changed by another process." % msg.pk )
+        self.stdout.write( "Message %s sent: %s delivered, %s failed." % ( msg.pk, succeeded, failed ) )
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Shared cache of the email addresses of contact groups.
+
+The normalised (lower-cased, sorted, without invalid addresses) email
+addresses of a group are stored zlib compressed in the Django cache named by
+the MAILER_GROUP_CACHE setting, so they can be reused by all messages and
+workers sending to the same group. The cache must be shared by all processes
+(e.g. memcached or redis) for invalidation to reach them, hence it is only
+used when explicitly configured - otherwise the addresses are read from the
+database each time.
+
+The cache entry of a group is invalidated when contacts are added to/removed
+from the group, or when a contact in the group is changed or deleted.
+"""
+
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+
+from djangoplicity.contacts.models import Contact, ContactGroup
+
+# Number of seconds the email addresses of a group are kept in the cache.
+GROUP_CACHE_TIMEOUT = getattr( settings, 'MAILER_GROUP_CACHE_TIMEOUT', 86400 )
+
+
+def get_group_contacts( group ):
+    """
+    Returns a queryset of the contacts in a group with a valid email address.
+    """
+    return group.contact_set.exclude( email__isnull=True ).exclude( email='' ).exclude( email__iendswith='-invalid' )
+
+
+def _get_cache():
+    """
+    Get the shared group cache, or None if MAILER_GROUP_CACHE is not set.
+    """
+    alias = getattr( settings, 'MAILER_GROUP_CACHE', None )
+    return caches[alias] if alias else None
+
+
+def _version_key( group_id ):
+    return 'mailer_group_version_%s' % group_id
+
+
+def _emails_key( group_id, version ):
+    return 'mailer_group_emails_%s_%s' % ( group_id, version )
+
+
+def _get_emails( group ):
+    return sorted( set( [e.lower() for e in get_group_contacts( group ).values_list( 'email', flat=True ).iterator()] ) )
+
+
+def get_group_emails( group, resolve=True ):
+    """
+    Get the sorted list of email addresses of a group. If resolve is false,
+    None is returned when the group is not in the cache (or no cache is
+    configured).
+    """
+    cache = _get_cache()
+    if cache is None:
+        return _get_emails( group ) if resolve else None
+
+    version = cache.get( _version_key( group.pk ) )
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set( _version_key( group.pk ), version, None )
+
+    data = cache.get( _emails_key( group.pk, version ) )
+    if data is not None:
+        data = zlib.decompress( data ).decode( 'utf-8' )
+        return data.split( '\n' ) if data else []
+
+    if not resolve:
+        return None
+
+    emails = _get_emails( group )
+    cache.set( _emails_key( group.pk, version ), zlib.compress( '\n'.join( emails ).encode( 'utf-8' ) ), GROUP_CACHE_TIMEOUT )
+    return emails
+
+
+def invalidate_groups( group_ids ):
+    """
+    Invalidate the cached email addresses of the given groups. Within a
+    transaction, the cache is invalidated once it is committed - otherwise a
+    concurrent send could cache the old rows under the new version.
+    """
+    cache = _get_cache()
+    if cache is None or not group_ids:
+        return
+
+    versions = dict( [( _version_key( pk ), uuid.uuid4().hex ) for pk in group_ids] )
+    transaction.on_commit( lambda: cache.set_many( versions, None ) )
+
+
+def _contact_group_ids( contact ):
+    return list( ContactGroup.objects.filter( contact=contact ).values_list( 'pk', flat=True ) )
+
+
+@receiver( post_save, sender=Contact )
+@receiver( pre_delete, sender=Contact )
+def contact_changed( sender, instance, **kwargs ):
+    if _get_cache() is None:
+        return
+    invalidate_groups( _contact_group_ids( instance ) )
+
+
+@receiver( m2m_changed )
+def contact_groups_changed( sender, instance, action, reverse, model, pk_set, **kwargs ):
+    if action not in ( 'post_add', 'post_remove', 'pre_clear' ) or _get_cache() is None:
+        return
+
+    if isinstance( instance, Contact ) and model is ContactGroup:
+        invalidate_groups( _contact_group_ids( instance ) if action == 'pre_clear' else pk_set )
+    elif isinstance( instance, ContactGroup ) and model is Contact:
+        invalidate_groups( [instance.pk] )
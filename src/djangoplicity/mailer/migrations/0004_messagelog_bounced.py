@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0003_auto_20151104_1428'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='bounced',
+            field=models.BooleanField(default=False, db_index=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0004_messagelog_bounced'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='clicks',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='opens',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='Link',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('url', models.TextField()),
+                ('clicks', models.PositiveIntegerField(default=0)),
+                ('message', models.ForeignKey(to='mailer.Message', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0005_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientHistory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('recipient', models.CharField(max_length=255, unique=True)),
+                ('last_sent', models.DateTimeField(db_index=True)),
+                ('sends', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name_plural': 'recipient histories',
+            },
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='frequency_cap_days',
+            field=models.PositiveIntegerField(blank=True, help_text='...in this number of days.', null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='frequency_cap_messages',
+            field=models.PositiveIntegerField(blank=True, help_text='Exclude recipients who have already received this number of messages...', null=True, validators=[django.core.validators.MaxValueValidator(20)]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0006_frequency_cap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='relay',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_status( apps, schema_editor ):
+    Message = apps.get_model( 'mailer', 'Message' )
+    Message.objects.filter( sent=True ).update( status='sent' )
+    # Queued messages have no send key, so a send run cannot be resumed
+    # safely - they must be sent again from the admin.
+    Message.objects.filter( sent=False, queued=True ).update( status='failed', queued=False )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0007_messagelog_relay'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('draft', 'Draft'), ('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, default='draft', editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='send_key',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='send_key',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagelog',
+            unique_together=set([('send_key', 'recipient')]),
+        ),
+        migrations.RunPython( set_status, migrations.RunPython.noop ),
+    ]
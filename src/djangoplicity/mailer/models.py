@@ -30,15 +30,69 @@
 # POSSIBILITY OF SUCH DAMAGE
 #
 
-from datetime import datetime
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.core import mail
-from django.db import models
+from django.core.validators import MaxValueValidator
+from django.db import OperationalError, models, transaction
+from django.db.models import Q
 from django.template import defaultfilters
 from django.utils.translation import ugettext_lazy as _
 
 from djangoplicity.contacts.models import ContactGroup
+from djangoplicity.mailer import optimize
+from djangoplicity.mailer.membership import get_group_contacts, get_group_emails
+from djangoplicity.mailer.signing import DKIMContext, SignedEmailMessage, SignedEmailMultiAlternatives, get_signer
 from djangoplicity.mailer.tasks import send_message
+from djangoplicity.mailer.tracking import create_links, get_tracking_url, make_token, rewrite_html
+
+logger = logging.getLogger( __name__ )
+
+# Number of rows inserted/deleted per query when synchronising recipients
+SYNC_BATCH_SIZE = 500
+
+# Number of send times kept per recipient in the RecipientHistory, which is
+# also the maximum number of messages for a frequency cap.
+RECIPIENT_HISTORY_SIZE = 20
+
+# Number of recipients claimed for a send run at once
+CLAIM_BATCH_SIZE = 100
+
+# Number of successful deliveries registered in the RecipientHistory at once
+HISTORY_BATCH_SIZE = 500
+
+# Number of attempts to update the RecipientHistory when the rows are locked
+# by concurrent sends.
+HISTORY_RETRIES = 5
+
+# Header added to all sent emails with the id of the message, used to link
+# bounces back to the message.
+MESSAGE_HEADER = 'X-Mailer-Message'
+
+# Send status of a message. Status changes are made with atomic conditional
+# updates (see Message._transition), so only one process can e.g. queue a
+# message or start/finish a send run.
+STATUS_DRAFT = 'draft'
+STATUS_QUEUED = 'queued'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+STATUS_CHOICES = (
+    (STATUS_DRAFT, 'Draft'),
+    (STATUS_QUEUED, 'Queued'),
+    (STATUS_SENDING, 'Sending'),
+    (STATUS_SENT, 'Sent'),
+    (STATUS_FAILED, 'Failed'),
+)
+
+# Fields only changed through atomic updates, which are therefore never
+# written by Message.save() for existing messages.
+STATUS_FIELDS = ( 'status', 'send_key', 'sent', 'queued', 'delivered', 'messages_delivered', 'messages_failed', 'opens', 'clicks' )
 
 EMAIL_TYPES = (
     ('P', 'Plain text'),
@@ -58,6 +112,12 @@ class Message( models.Model ):
     # Queued for sending means a celery task have been dispatched, and the background worker might be working on sending
     queued = models.BooleanField( default=False, help_text=_("Message is queued for sending.") )
 
+    # Send status (see STATUS_CHOICES)
+    status = models.CharField( max_length=10, choices=STATUS_CHOICES, default=STATUS_DRAFT, db_index=True, editable=False )
+
+    # Idempotency key of the current/last send run
+    send_key = models.CharField( max_length=32, blank=True, editable=False )
+
     # Date/time a worker finished sending the message
     delivered = models.DateTimeField( blank=True, null=True, editable=False )
 
@@ -70,6 +130,10 @@ class Message( models.Model ):
     # List of Contact groups that should be send the email
     contact_groups = models.ManyToManyField(ContactGroup, help_text=_('Contact groups that will receive the email'), blank=True)
 
+    # Frequency cap - don't send to recipients who already received this number of messages in the given number of days
+    frequency_cap_messages = models.PositiveIntegerField( blank=True, null=True, validators=[MaxValueValidator( RECIPIENT_HISTORY_SIZE )], help_text=_( "Exclude recipients who have already received this number of messages..." ) )
+    frequency_cap_days = models.PositiveIntegerField( blank=True, null=True, help_text=_( "...in this number of days." ) )
+
     # HTML or plain text - nothing else supported
     type = models.CharField( max_length=1, choices=EMAIL_TYPES, default='P', help_text=_("For plain-text emails only fill-in the plain text field. For HTML emails, please fill-in both the HTML and the plain-text fields.") )
 
@@ -83,118 +147,381 @@ class Message( models.Model ):
     created = models.DateTimeField( auto_now_add=True )
     last_modified = models.DateTimeField( auto_now=True )
 
+    # Number of opens/clicks registered by the tracking views (HTML emails only)
+    opens = models.PositiveIntegerField( default=0, editable=False )
+    clicks = models.PositiveIntegerField( default=0, editable=False )
+
+    @staticmethod
+    def get_connection():
+        """
+        Get a connection to the email backend used for sending messages
+        (MAILER_EMAIL_BACKEND setting, or the default email backend).
+        """
+        return mail.get_connection( getattr( settings, 'MAILER_EMAIL_BACKEND', None ) )
+
     def get_from( self ):
         """
         Construct the header value for the "from:" email header field.
         """
         return "\"%s\" <%s>" % ( self.from_name, self.from_email ) if self.from_name else self.from_email
 
+    get_group_contacts = staticmethod( get_group_contacts )
+
     def get_contact_groups_recipients(self):
         '''
-        Returns a list of (ContactGroup, Recipients)
+        Returns a list of (ContactGroup, Recipients). The recipients of each
+        group are taken from the shared group cache if configured (see
+        membership.py).
         '''
         recipients = []
         for group in self.contact_groups.all():
             recipients.append(
-                (group, [c.email for c in group.contact_set.all() if c.email and not c.email.lower().endswith('-invalid')])
+                (group, get_group_emails(group))
             )
 
         return recipients
 
+    def get_contact_groups_counts(self):
+        '''
+        Returns a list of (ContactGroup, number of recipients) - the counts
+        are taken from the group cache if available, otherwise only the
+        counts are retrieved from the database, not the email addresses.
+        '''
+        counts = []
+        for group in self.contact_groups.all():
+            emails = get_group_emails(group, resolve=False)
+            counts.append((group, len(emails) if emails is not None else self.get_group_contacts(group).count()))
+
+        return counts
+
     def get_recipients_count( self ):
         """
         Get number of recipients for this email list.
         """
         count = 0
-        for _group, recipients in self.get_contact_groups_recipients():
-            count += len(recipients)
+        for _group, group_count in self.get_contact_groups_counts():
+            count += group_count
 
         return count + Recipient.objects.filter( message=self ).count()
     get_recipients_count.short_description = _( "Recipients" )
 
-    def _send( self, test=True, emails=[] ):
+    def get_recipients( self ):
+        """
+        Get the list of email addresses the message should be sent to (both
+        the recipients defined for the message and the contact groups
+        recipients). Email addresses are lower-cased and duplicates removed.
+        """
+        recipients = list(self.recipient_set.all().values_list( 'to_email', flat=True ))
+
+        # Add recipients from selected contact groups
+        for _group, emails in self.get_contact_groups_recipients():
+            recipients += emails
+
+        # Remove duplicates
+        recipients = set( [x.lower() for x in recipients] )
+
+        # Remove recipients who have already received too many messages
+        if self.frequency_cap_messages and self.frequency_cap_days:
+            recipients -= RecipientHistory.get_capped( self.frequency_cap_messages, self.frequency_cap_days )
+
+        return recipients
+
+    def sync_recipients( self, emails ):
+        """
+        Replace the recipients of this message with the given list of email
+        addresses. Only the difference against the existing recipients is
+        written to the database. Returns a tuple with the number of added,
+        kept and removed recipients.
+        """
+        emails = set( [x.lower() for x in emails] )
+
+        with transaction.atomic():
+            existing = set( self.recipient_set.values_list( 'to_email', flat=True ) )
+
+            added = emails - existing
+            removed = list( existing - emails )
+
+            for i in range( 0, len( removed ), SYNC_BATCH_SIZE ):
+                self.recipient_set.filter( to_email__in=removed[i:i + SYNC_BATCH_SIZE] ).delete()
+
+            Recipient.objects.bulk_create( [Recipient( message=self, to_email=e ) for e in added], batch_size=SYNC_BATCH_SIZE )
+
+        return len( added ), len( existing & emails ), len( removed )
+
+    def get_unsent_recipients( self ):
+        """
+        Get the recipients of the message which have not yet successfully
+        received it, and are not being sent to, in a previous (e.g. failed or
+        interrupted) send run.
+        """
+        claimed = MessageLog.objects.filter( message=self ).exclude( send_key=None ).filter( Q( success=True ) | Q( success__isnull=True ) )
+        return self.get_recipients() - set( claimed.values_list( 'recipient', flat=True ) )
+
+    def _transition( self, from_status, to_status, key=None, **fields ):
+        """
+        Atomically change the status of the message from one of the statuses
+        in from_status (and the given send key) to to_status, also setting
+        the given fields. Returns False if the message was not in one of the
+        required statuses, e.g. because another process changed it.
+
+        The send key is required to change a message which is queued, being
+        sent or sent - only draft and failed messages have no current run.
+        """
+        qs = Message.objects.filter( pk=self.pk, status__in=from_status )
+        if key or set( from_status ) - set( ( STATUS_DRAFT, STATUS_FAILED ) ):
+            if not key:
+                return False
+            qs = qs.filter( send_key=key )
+
+        fields['status'] = to_status
+        if not qs.update( **fields ):
+            return False
+
+        for name, value in fields.items():
+            setattr( self, name, value )
+        return True
+
+    def _start_send( self, from_status, key=None ):
+        """
+        Start a new send run. Returns the send key of the run, or None if the
+        message has already been queued or sent. The tracked links are
+        created here, before the workers of the run are started.
+        """
+        send_key = uuid.uuid4().hex
+        if not self._transition( from_status, STATUS_QUEUED, key=key, queued=True, send_key=send_key ):
+            return None
+        if self.is_html() and get_tracking_url():
+            create_links( self, self._get_content()[0] )
+        return send_key
+
+    def _send( self, test=True, emails=[], send_key=None ):
         """
         Send message for real (called by the worker node). Use send_now() or send_test() instead
         of this function. Function is used to send both test emails and the real deal.
-        """
 
+        For real sends, the send key of the run must be given. The send is
+        skipped if the key is missing (e.g. a task queued before send runs
+        were introduced) or the run is not current (e.g. duplicate task). Several
+        workers (or a retried task) may run with the same key - each
+        recipient is only sent to once per message. Returns False if the send
+        was skipped or stopped because the run is no longer current.
+        """
         if test:
-            recipients = emails
+            # Remove duplicates
+            recipients = set( [x.lower() for x in emails] )
+            # Test emails are not tracked
+            self._tracking_html = None
         else:
-            recipients = list(self.recipient_set.all().values_list( 'to_email', flat=True ))
-
-            # Add recipients from selected contact groups
-            for _group, emails in self.get_contact_groups_recipients():
-                recipients += emails
+            if not send_key or not self._transition( ( STATUS_QUEUED, STATUS_SENDING ), STATUS_SENDING, key=send_key ):
+                return False
+            recipients = self.get_unsent_recipients()
+
+        try:
+            if len( recipients ) > 0:
+                # Open a connection a keep it open until we have sent everything.
+                connection = self.get_connection()
+
+                self._send_emails( connection, recipients, send_key=send_key )
+
+                # TODO: strange django problem. Throws an exception when
+                # closing a conncetion to the mail_debug server.
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+        except Exception:
+            if not test:
+                self._transition( ( STATUS_SENDING, ), STATUS_FAILED, key=send_key, queued=False )
+            raise
 
-        # Remove duplicates
-        recipients = set( [x.lower() for x in recipients] )
+        if not test:
+            return self._set_delivered( send_key )
+        return True
 
+    def _send_emails( self, conn, recipients, send_key=None ):
+        """
+        Send this message to a list of email addresses using an already open
+        connection. Returns a tuple with the number of succeeded and failed
+        deliveries.
+
+        If a send key is given (i.e. not a test send), the recipients are
+        claimed in batches (see _claim) and recipients already claimed are
+        skipped. Sending stops when the send run is no longer current (e.g.
+        the message failed in another worker). Successful deliveries are added
+        to the recipients' send history (used for frequency capping).
+        """
         succeeded = 0
         failed = 0
-
-        if len( recipients ) > 0:
-            # Open a connection a keep it open until we have sent everything.
-            connection = mail.get_connection()
-
-            for r in recipients:
-                if self._send_email( connection, r ):
+        sent = []
+
+        recipients = list( recipients )
+        for i in range( 0, len( recipients ), CLAIM_BATCH_SIZE ):
+            batch = recipients[i:i + CLAIM_BATCH_SIZE]
+            if send_key:
+                logs = self._claim( batch, send_key )
+                if logs is None:
+                    break
+            else:
+                logs = [MessageLog( message=self, recipient=r ) for r in batch]
+
+            for log in logs:
+                if self._send_email( conn, log ):
                     succeeded += 1
+                    sent.append( log.recipient )
                 else:
                     failed += 1
 
-            # TODO: strange django problem. Throws an exception when
-            # closing a conncetion to the mail_debug server.
-            try:
-                connection.close()
-            except Exception:
-                pass
+            # Write the results of the batch at once
+            MessageLog.objects.bulk_update( [l for l in logs if l.pk], ['success', 'relay'] )
+            MessageLog.objects.bulk_create( [l for l in logs if not l.pk] )
 
-        if not test:
-            self.messages_delivered = succeeded
-            self.messages_failed = failed
-            self.delivered = datetime.now()
-            self.sent = True
-            self.save()
+            if send_key and len( sent ) >= HISTORY_BATCH_SIZE:
+                self._add_history( sent )
+                sent = []
+
+        if send_key and sent:
+            self._add_history( sent )
+
+        return succeeded, failed
+
+    def _add_history( self, recipients ):
+        """
+        Add a send to the recipients' send history. Errors are only logged, so
+        the frequency cap bookkeeping never stops a send.
+        """
+        try:
+            RecipientHistory.add_sends( recipients )
+        except Exception:
+            logger.exception( "Could not update the send history of %s recipients of message %s." % ( len( recipients ), self.pk ) )
+
+    def _claim( self, recipients, send_key ):
+        """
+        Claim recipients for a send run by creating their log entries before
+        sending (with success set to None while the delivery is in progress).
+        Recipients claimed by the run, or delivered or being delivered by
+        another run, are skipped - recipients whose delivery failed in another
+        run are sent to again. Returns the log entries of the claimed
+        recipients, or None if the send run is no longer current.
+
+        The message row is updated first, which locks it until the end of the
+        transaction, so claims and status changes of all workers and runs are
+        serialised. Recipients claimed by a worker which is killed are not
+        sent to again.
+        """
+        with transaction.atomic():
+            if not Message.objects.filter( pk=self.pk, status=STATUS_SENDING, send_key=send_key ).update( status=STATUS_SENDING ):
+                return None
 
-    def _send_email( self, conn, emailaddr ):
+            claimed = set( MessageLog.objects.filter( message=self, recipient__in=recipients ).exclude( send_key=None ).filter(
+                Q( send_key=send_key ) | Q( success=True ) | Q( success__isnull=True )
+            ).values_list( 'recipient', flat=True ) )
+            unclaimed = [r for r in recipients if r not in claimed]
+
+            MessageLog.objects.bulk_create( [MessageLog( message=self, recipient=r, send_key=send_key, success=None ) for r in unclaimed] )
+            return list( MessageLog.objects.filter( message=self, send_key=send_key, recipient__in=unclaimed ) )
+
+    def _set_delivered( self, send_key ):
+        """
+        Mark the message as sent to all recipients. The numbers of delivered
+        and failed messages are taken from the message log, so they include
+        deliveries made by all workers of the send run.
         """
-        Send this message to a single email address using an already open connection.
-        Result is logged to the database.
+        logs = MessageLog.objects.filter( message=self ).exclude( send_key=None )
+        return self._transition(
+            ( STATUS_SENDING, STATUS_SENT ), STATUS_SENT, key=send_key,
+            sent=True,
+            delivered=datetime.now(),
+            messages_delivered=logs.filter( success=True ).count(),
+            messages_failed=logs.filter( success=False, send_key=send_key ).count(),
+        )
+
+    def _get_dkim_context( self ):
         """
+        Get the DKIM signing context shared by all emails sent by this
+        instance (None if DKIM signing is not configured).
+        """
+        if not hasattr( self, '_dkim_context' ):
+            signer = get_signer()
+            self._dkim_context = DKIMContext( signer ) if signer else None
+        return self._dkim_context
+
+    def _get_tracking_html( self ):
+        """
+        Get the HTML version with rewritten links for open/click tracking,
+        as a list of parts to join with the recipient's token (None if
+        tracking is not enabled). Links are only rewritten once for
+        all emails sent by this instance.
+        """
+        if not hasattr( self, '_tracking_html' ):
+            self._tracking_html = rewrite_html( self, self._get_content()[0] ) if self.is_html() and get_tracking_url() else None
+        return self._tracking_html
+
+    def _get_content( self ):
+        """
+        Get the (HTML, plain text) content to send. If MAILER_OPTIMIZE_HTML is
+        enabled, the content is optimised once for all emails sent by this
+        instance (see optimize.py).
+        """
+        if not hasattr( self, '_content' ):
+            if optimize.is_enabled():
+                self._content = optimize.optimize( self.html_text if self.is_html() else '', self.plain_text )
+            else:
+                self._content = ( self.html_text, self.plain_text )
+        return self._content
+
+    def _send_email( self, conn, log ):
+        """
+        Send this message to the recipient of a log entry using an already
+        open connection. The result is set on the log entry, which is saved
+        by the caller.
+        """
+        if not self.is_plaintext() and not self.is_html():
+            log.success = False
+            return False
+
+        emailaddr = log.recipient
         msg = None
         if self.is_plaintext():
             # Construct message
-            msg = mail.EmailMessage( subject=self.subject, body=self.plain_text, from_email=self.get_from(), to=[emailaddr], connection=conn )
+            msg = SignedEmailMessage( subject=self.subject, body=self._get_content()[1], from_email=self.get_from(), to=[emailaddr], connection=conn )
             if self.reply_to:
                 msg.headers = { 'Reply-To': self.reply_to }
         elif self.is_html():
-            msg = mail.EmailMultiAlternatives( subject=self.subject, body=self.plain_text, from_email=self.get_from(), to=[emailaddr], connection=conn )
-            msg.attach_alternative( self.html_text, "text/html" )
-
-        if msg:
-            # Construct log message
-            log = MessageLog( message=self, recipient=emailaddr )
-
-            # Send the message
-            try:
-                msg.send( fail_silently=False )
-                log.success = True
-            except Exception:
-                log.success = False
-
-            # Save log
-            log.save()
-            return log.success
-        return False
+            msg = SignedEmailMultiAlternatives( subject=self.subject, body=self._get_content()[1], from_email=self.get_from(), to=[emailaddr], connection=conn )
+            html = self._get_tracking_html()
+            if html is None:
+                msg.attach_alternative( self._get_content()[0], "text/html" )
+            else:
+                # The tracking token identifies the log entry.
+                if log.pk is None:
+                    log.save()
+                msg.attach_alternative( make_token( self.pk, log.pk ).join( html ), "text/html" )
+                # Body is different for each recipient.
+                msg.dkim_shared_body = False
+
+        msg.extra_headers[MESSAGE_HEADER] = str( self.pk )
+        msg.dkim_context = self._get_dkim_context()
+
+        # Send the message
+        try:
+            msg.send( fail_silently=False )
+            log.success = True
+        except Exception:
+            log.success = False
+        log.relay = getattr( msg, 'relay', '' )
+        return log.success
 
     def send_now( self ):
         """
         Send message now - message will be queued to be sent via a background worker.
+        Returns False if the message have already been queued or sent.
         """
-        self.queued = True
-        self.save()
-        send_message.delay( msg_id=self.pk, test=False )
+        send_key = self._start_send( ( STATUS_DRAFT, STATUS_FAILED ) )
+        if send_key is None:
+            return False
+
+        send_message.delay( msg_id=self.pk, test=False, send_key=send_key )
+        return True
 
     def send_test(self, emails):
         """
@@ -215,6 +542,11 @@ class Message( models.Model ):
                     self.plain_text = html2text.html2text( self.html_text )
                 elif self.plain_text != '' and self.html_text == '':
                     self.html_text = defaultfilters.linebreaks( self.plain_text )
+
+        # Status fields of existing messages are only changed through atomic updates.
+        if not self._state.adding and not kwargs.get( 'update_fields' ) and not kwargs.get( 'force_insert' ):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in STATUS_FIELDS]
+
         super( Message, self ).save( *args, **kwargs )
 
     def is_html(self):
@@ -239,7 +571,97 @@ class MessageLog( models.Model ):
     timestamp = models.DateTimeField( auto_now_add=True, db_index=True )
     message = models.ForeignKey( Message, on_delete=models.CASCADE)
     recipient = models.CharField( max_length=255, db_index=True )
-    success = models.BooleanField( default=False, db_index=True )
+    # None while the delivery is in progress (see Message._claim)
+    success = models.BooleanField( default=False, null=True, db_index=True )
+    # A delivery status notification have been received for the recipient
+    bounced = models.BooleanField( default=False, db_index=True )
+    # Name of the SMTP relay used (see djangoplicity.mailer.relays)
+    relay = models.CharField( max_length=100, blank=True, db_index=True )
+    # Send run key (not set for test sends), a recipient is only sent once per message
+    send_key = models.CharField( max_length=32, blank=True, null=True )
+
+    class Meta:
+        unique_together = ['send_key', 'recipient']
+
+
+class Link( models.Model ):
+    """
+    Link in a message which is tracked by the click tracking view.
+    """
+    message = models.ForeignKey( Message, on_delete=models.CASCADE )
+    url = models.TextField()
+    clicks = models.PositiveIntegerField( default=0 )
+
+    def __unicode__( self ):
+        return self.url
+
+
+class RecipientHistory( models.Model ):
+    """
+    Index of the most recent sends to each recipient, used for frequency
+    capping. The send times are stored as a space-separated list of
+    timestamps, so checking the cap only requires reading the rows of the
+    recipients who received a message within the cap period.
+    """
+    recipient = models.CharField( max_length=255, unique=True )
+    last_sent = models.DateTimeField( db_index=True )
+    sends = models.TextField( blank=True )
+
+    @classmethod
+    def add_sends( cls, recipients ):
+        """
+        Register a send to the given list of recipients now.
+        """
+        now = datetime.now()
+        timestamp = str( int( time.time() ) )
+        recipients = set( recipients )
+
+        # Create missing rows first - rows created concurrently by another
+        # send are ignored - so all rows can be locked and updated below.
+        existing = set( cls.objects.filter( recipient__in=recipients ).values_list( 'recipient', flat=True ) )
+        cls.objects.bulk_create(
+            [cls( recipient=r, last_sent=now, sends='' ) for r in recipients if r not in existing],
+            batch_size=SYNC_BATCH_SIZE, ignore_conflicts=True
+        )
+
+        for attempt in range( HISTORY_RETRIES ):
+            try:
+                with transaction.atomic():
+                    # Rows are locked in a fixed order to avoid deadlocks between sends.
+                    objs = list( cls.objects.select_for_update().filter( recipient__in=recipients ).order_by( 'recipient' ) )
+                    for obj in objs:
+                        obj.last_sent = now
+                        obj.sends = " ".join( ( obj.sends.split() + [timestamp] )[-RECIPIENT_HISTORY_SIZE:] )
+                    cls.objects.bulk_update( objs, ['last_sent', 'sends'], batch_size=SYNC_BATCH_SIZE )
+                return
+            except OperationalError:
+                # Lock timeout or deadlock with a concurrent send (e.g. SQLite
+                # cannot upgrade the read lock while another send writes).
+                if attempt == HISTORY_RETRIES - 1:
+                    raise
+                time.sleep( 0.1 * ( attempt + 1 ) )
+
+    @classmethod
+    def get_capped( cls, messages, days ):
+        """
+        Get the set of recipients who have received at least the given number
+        of messages in the given number of days.
+        """
+        since = datetime.now() - timedelta( days=days )
+        since_timestamp = time.time() - days * 86400
+
+        capped = set()
+        for recipient, sends in cls.objects.filter( last_sent__gte=since ).values_list( 'recipient', 'sends' ).iterator():
+            if len( [x for x in sends.split() if int( x ) >= since_timestamp] ) >= messages:
+                capped.add( recipient )
+
+        return capped
+
+    def __unicode__( self ):
+        return self.recipient
+
+    class Meta:
+        verbose_name_plural = 'recipient histories'
 
 
 class Recipient( models.Model ):
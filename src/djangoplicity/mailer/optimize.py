@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Optional one-time optimisation of the content of a message before sending:
+
+ * CSS from <style> blocks is inlined (requires the premailer package).
+ * Comments and redundant whitespace (e.g. between block-level tags) are
+   removed from the HTML.
+ * Trailing whitespace and repeated blank lines are removed from the plain
+   text version.
+
+The result is cached by content hash, so the processing is only done once
+per message content. Enabled with the MAILER_OPTIMIZE_HTML setting.
+"""
+
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Number of seconds the optimised content is kept in the cache.
+OPTIMIZE_CACHE_TIMEOUT = getattr( settings, 'MAILER_OPTIMIZE_CACHE_TIMEOUT', 86400 )
+
+# Elements in which whitespace is significant or which must not be touched.
+_PRESERVE_RE = re.compile( r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL )
+# HTML comments, except conditional comments used for Outlook.
+_COMMENT_RE = re.compile( r'<!--(?!\[if|<!\[endif).*?-->', re.DOTALL )
+_WHITESPACE_RE = re.compile( r'\s+' )
+# Whitespace around block-level tags is not rendered, unlike whitespace
+# between inline elements.
+_BLOCK_WHITESPACE_RE = re.compile(
+    r'\s*(</?(?:html|head|title|meta|link|body|div|center|p|h[1-6]|blockquote|ul|ol|li|table|thead|tbody|tfoot|tr|td|th|br|hr)\b[^>]*>)\s*',
+    re.IGNORECASE
+)
+_TRAILING_WHITESPACE_RE = re.compile( r'[ \t]+$', re.MULTILINE )
+_BLANK_LINES_RE = re.compile( r'\n{3,}' )
+
+
+def inline_css( html ):
+    """
+    Inline CSS from <style> blocks into style attributes. The HTML is
+    returned unchanged if premailer is not installed.
+    """
+    try:
+        import premailer
+    except ImportError:
+        return html
+
+    return premailer.transform( html, keep_style_tags=True, disable_validation=True )
+
+
+def minify_html( html ):
+    """
+    Remove comments, collapse whitespace and remove whitespace around
+    block-level tags, except within <pre>, <textarea>, <script> and <style>
+    elements.
+    """
+    parts = _PRESERVE_RE.split( html )
+    result = []
+
+    # re.split with two groups returns [text, element, tag name, text, ...]
+    for i in range( 0, len( parts ), 3 ):
+        text = _COMMENT_RE.sub( '', parts[i] )
+        text = _BLOCK_WHITESPACE_RE.sub( r'\1', _WHITESPACE_RE.sub( ' ', text ) )
+        result.append( text )
+        if i + 1 < len( parts ):
+            result.append( parts[i + 1] )
+
+    return ''.join( result ).strip()
+
+
+def tidy_text( text ):
+    """
+    Normalise line endings and remove trailing whitespace and repeated blank
+    lines from a plain text message.
+    """
+    text = text.replace( '\r\n', '\n' ).replace( '\r', '\n' )
+    text = _TRAILING_WHITESPACE_RE.sub( '', text )
+    return _BLANK_LINES_RE.sub( '\n\n', text ).strip() + '\n'
+
+
+def optimize( html, text ):
+    """
+    Get the optimised (html, text) content of a message. The result is
+    cached by content hash.
+    """
+    digest = hashlib.sha1( ( html + '\0' + text ).encode( 'utf-8' ) ).hexdigest()
+    key = 'mailer_optimized_%s' % digest
+
+    content = cache.get( key )
+    if content is None:
+        content = ( minify_html( inline_css( html ) ) if html else html, tidy_text( text ) if text else text )
+        cache.set( key, content, OPTIMIZE_CACHE_TIMEOUT )
+
+    return content
+
+
+def is_enabled():
+    return getattr( settings, 'MAILER_OPTIMIZE_HTML', False )
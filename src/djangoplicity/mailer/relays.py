@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Email backend which distributes outgoing mail over several SMTP relays.
+
+Relays are configured with the MAILER_RELAYS setting::
+
+    MAILER_RELAYS = [
+        { 'name': 'relay1', 'host': 'smtp1.example.org', 'port': 25, 'weight': 3 },
+        { 'name': 'relay2', 'host': 'smtp2.example.org', 'port': 587, 'weight': 1,
+          'username': '...', 'password': '...', 'use_tls': True,
+          'domains': ['gmail.com', 'googlemail.com'] },
+    ]
+
+and the backend is enabled for the mailer with::
+
+    MAILER_EMAIL_BACKEND = 'djangoplicity.mailer.relays.RelayEmailBackend'
+
+Emails to a recipient domain listed in a relay's "domains" are sent via that
+relay, all other emails via a relay chosen at random according to the
+weights. If a relay cannot be reached or replies with a temporary (4xx)
+error, it is marked as down for MAILER_RELAY_RETRY seconds (default 60) and
+the email is sent via the next relay. Emails permanently rejected by a relay
+(5xx) fail without trying the other relays. The name of the relay used is
+stored in the "relay" attribute of the sent email.
+"""
+
+import random
+import smtplib
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+
+
+class Relay( object ):
+    """
+    SMTP relay with health status and send count.
+    """
+    def __init__( self, name, host, port=25, weight=1, domains=None, **kwargs ):
+        self.name = name
+        self.weight = weight
+        self.domains = set( [d.lower() for d in ( domains or [] )] )
+        self.backend = SMTPEmailBackend( host=host, port=port, fail_silently=False, **kwargs )
+        self.down_until = 0
+        self.sent = 0
+        self.failed = 0
+
+    def is_up( self ):
+        return time.time() >= self.down_until
+
+    def mark_down( self, retry ):
+        self.failed += 1
+        self.down_until = time.time() + retry
+        try:
+            self.backend.close()
+        except Exception:
+            pass
+
+    def send( self, message ):
+        """
+        Send a message via this relay (the connection is kept open).
+        """
+        if self.backend.connection is None:
+            self.backend.open()
+        self.backend.send_messages( [message] )
+        self.sent += 1
+
+
+class RelayEmailBackend( BaseEmailBackend ):
+    """
+    Email backend routing messages over several SMTP relays with weights,
+    per-domain rules and failover.
+    """
+    def __init__( self, relays=None, retry=None, fail_silently=False, **kwargs ):
+        super( RelayEmailBackend, self ).__init__( fail_silently=fail_silently )
+        relays = relays if relays is not None else getattr( settings, 'MAILER_RELAYS', [] )
+        if not relays:
+            raise ImproperlyConfigured( "MAILER_RELAYS must define at least one relay." )
+        self.relays = [Relay( **r ) for r in relays]
+        self.retry = retry if retry is not None else getattr( settings, 'MAILER_RELAY_RETRY', 60 )
+        self.random = random.Random()
+        self._lock = threading.RLock()
+
+    def open( self ):
+        # Relay connections are opened when first used.
+        return False
+
+    def close( self ):
+        for relay in self.relays:
+            try:
+                relay.backend.close()
+            except Exception:
+                pass
+
+    def get_counts( self ):
+        """
+        Get a dictionary of relay name -> number of sent emails.
+        """
+        return dict( [( r.name, r.sent ) for r in self.relays] )
+
+    def get_relays( self, message ):
+        """
+        Get the relays to try for a message, in order of preference.
+        """
+        domains = set( [addr.rsplit( '@', 1 )[-1].lower() for addr in message.recipients()] )
+
+        up = [r for r in self.relays if r.is_up()]
+        down = [r for r in self.relays if not r.is_up()]
+
+        # Relays with a rule for the recipient's domain first
+        preferred = [r for r in up if r.domains & domains]
+        others = [r for r in up if not r.domains & domains]
+
+        # Remaining relays in random order according to their weights
+        ordered = []
+        while others:
+            total = sum( [r.weight for r in others] )
+            pick = self.random.uniform( 0, total )
+            for r in others:
+                pick -= r.weight
+                if pick <= 0:
+                    break
+            ordered.append( r )
+            others.remove( r )
+
+        # Try relays marked as down as a last resort
+        return preferred + ordered + down
+
+    @staticmethod
+    def is_temporary( error ):
+        """
+        Check if an SMTP error is a temporary (4xx) failure.
+        """
+        return 400 <= getattr( error, 'smtp_code', 0 ) < 500
+
+    def send_messages( self, email_messages ):
+        if not email_messages:
+            return 0
+
+        sent = 0
+        with self._lock:
+            for message in email_messages:
+                if not message.recipients():
+                    continue
+                if self._send( message ):
+                    sent += 1
+        return sent
+
+    def _send( self, message ):
+        error = None
+
+        for relay in self.get_relays( message ):
+            try:
+                relay.send( message )
+                message.relay = relay.name
+                return True
+            except smtplib.SMTPRecipientsRefused as e:
+                # Recipient refused - another relay will not help.
+                error = e
+                break
+            except ( smtplib.SMTPSenderRefused, smtplib.SMTPDataError ) as e:
+                error = e
+                if not self.is_temporary( e ):
+                    # Message permanently rejected - the relay is fine and
+                    # another relay will not help.
+                    break
+                relay.mark_down( self.retry )
+            except ( smtplib.SMTPException, socket.error ) as e:
+                # Connection or relay level errors (e.g. server disconnected,
+                # HELO or authentication failed). SMTPException is a subclass
+                # of socket.error, hence this is handled last.
+                relay.mark_down( self.retry )
+                error = e
+
+        if error is not None and not self.fail_silently:
+            raise error
+        return False
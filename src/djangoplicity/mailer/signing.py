@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+DKIM signing (RFC 6376) of outgoing emails. The private key is loaded once
+per process and the body hash is computed once per message send, so signing
+each recipient's email only requires hashing and signing the headers.
+
+Signing is enabled by defining the following settings:
+
+ * MAILER_DKIM_DOMAIN - signing domain (e.g. "eso.org").
+ * MAILER_DKIM_SELECTOR - selector of the DNS record with the public key.
+ * MAILER_DKIM_PRIVATE_KEY - path to the PEM-encoded RSA private key.
+
+Requires the dkimpy package for parsing the key and computing the RSA signature.
+"""
+
+import base64
+import hashlib
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core import mail
+
+# Headers included in the signature (if present in the email).
+SIGNED_HEADERS = [ 'from', 'to', 'subject', 'date', 'message-id', 'reply-to', 'mime-version', 'content-type', 'content-transfer-encoding' ]
+
+_WSP_RE = re.compile( br'[\t ]+' )
+_TRAILING_WSP_RE = re.compile( br'[\t ]+\r\n' )
+_TRAILING_LINES_RE = re.compile( br'(\r\n)+$' )
+
+# Signer used by this process (see get_signer()).
+_signer = None
+
+
+def canonicalize_header( name, value ):
+    """
+    Relaxed header canonicalization.
+    """
+    value = value.encode( 'ascii' ) if not isinstance( value, bytes ) else value
+    value = _WSP_RE.sub( b' ', value.replace( b'\r\n', b'' ).replace( b'\n', b'' ) ).strip()
+    return name.lower().strip().encode( 'ascii' ) + b':' + value
+
+
+def canonicalize_body( body ):
+    """
+    Relaxed body canonicalization.
+    """
+    if body and not body.endswith( b'\r\n' ):
+        body += b'\r\n'
+    body = _TRAILING_WSP_RE.sub( b'\r\n', _WSP_RE.sub( b' ', body ) )
+    body = _TRAILING_LINES_RE.sub( b'', body )
+    return body + b'\r\n' if body else b''
+
+
+class DKIMSigner( object ):
+    """
+    RSA-SHA256 signer with relaxed/relaxed canonicalization.
+    """
+    def __init__( self, domain, selector, private_key ):
+        from dkim.crypto import parse_pem_private_key
+
+        self.domain = domain
+        self.selector = selector
+        self.private_key = parse_pem_private_key( private_key )
+
+    def body_hash( self, body ):
+        """
+        Compute the body hash of a raw email body (with CRLF line endings).
+        """
+        return base64.b64encode( hashlib.sha256( canonicalize_body( body ) ).digest() ).decode( 'ascii' )
+
+    def sign( self, msg, body_hash ):
+        """
+        Add the DKIM-Signature header to an email.message.Message, using an
+        already computed body hash.
+        """
+        from dkim.crypto import RSASSA_PKCS1_v1_5_sign
+
+        headers = [( h, msg[h] ) for h in SIGNED_HEADERS if msg[h] is not None]
+
+        value = "v=1; a=rsa-sha256; c=relaxed/relaxed; d=%s; s=%s; t=%d; h=%s; bh=%s; b=" % (
+            self.domain, self.selector, int( time.time() ), ":".join( [h for h, _v in headers] ), body_hash
+        )
+
+        data = b''.join( [canonicalize_header( h, str( v ) ) + b'\r\n' for h, v in headers] )
+        data += canonicalize_header( 'dkim-signature', value )
+
+        signature = RSASSA_PKCS1_v1_5_sign( hashlib.sha256( data ), self.private_key )
+        msg['DKIM-Signature'] = value + base64.b64encode( signature ).decode( 'ascii' )
+
+
+class DKIMContext( object ):
+    """
+    Signing state for one send of a message. All emails of the send share the
+    same MIME boundary, so their bodies are identical and the body hash only
+    has to be computed for the first email.
+    """
+    def __init__( self, signer ):
+        self.signer = signer
+        self.boundary = '===============%s==' % uuid.uuid4().hex
+        self.body_hash = None
+
+    def sign( self, msg, shared_body=True ):
+        """
+        Sign an email. If shared_body is false, the body of the email differs
+        from the other emails of the send, and the body hash is computed
+        only for this email.
+        """
+        if msg.is_multipart():
+            msg.set_boundary( self.boundary )
+
+        if shared_body and self.body_hash is not None:
+            body_hash = self.body_hash
+        else:
+            body_hash = self.signer.body_hash( msg.as_bytes( linesep='\r\n' ).split( b'\r\n\r\n', 1 )[-1] )
+            if shared_body:
+                self.body_hash = body_hash
+
+        self.signer.sign( msg, body_hash )
+
+
+class SignedEmailMixin( object ):
+    """
+    Mixin for Django email classes which DKIM signs the message when a
+    signing context is set.
+    """
+    dkim_context = None
+    dkim_shared_body = True
+
+    def message( self ):
+        msg = super( SignedEmailMixin, self ).message()
+        if self.dkim_context is not None:
+            self.dkim_context.sign( msg, shared_body=self.dkim_shared_body )
+        return msg
+
+
+class SignedEmailMessage( SignedEmailMixin, mail.EmailMessage ):
+    pass
+
+
+class SignedEmailMultiAlternatives( SignedEmailMixin, mail.EmailMultiAlternatives ):
+    pass
+
+
+def get_signer():
+    """
+    Get the DKIM signer for this process, or None if signing is not
+    configured. The private key is only loaded and parsed once.
+    """
+    global _signer
+
+    if _signer is None and getattr( settings, 'MAILER_DKIM_DOMAIN', None ):
+        with open( settings.MAILER_DKIM_PRIVATE_KEY, 'rb' ) as f:
+            _signer = DKIMSigner( settings.MAILER_DKIM_DOMAIN, settings.MAILER_DKIM_SELECTOR, f.read() )
+
+    return _signer
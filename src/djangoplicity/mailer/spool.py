@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Email backend handing messages over to the local MTA, instead of sending
+them via SMTP.
+
+Messages are either written to a pickup/spool directory read by the MTA::
+
+    MAILER_EMAIL_BACKEND = 'djangoplicity.mailer.spool.SpoolEmailBackend'
+    MAILER_SPOOL_DIR = '/var/spool/mailer/pickup'
+
+or piped to a sendmail-compatible binary::
+
+    MAILER_EMAIL_BACKEND = 'djangoplicity.mailer.spool.SpoolEmailBackend'
+    MAILER_SPOOL_SENDMAIL = '/usr/sbin/sendmail'
+
+Each message is written to a temporary file (starting with a dot) in the
+spool directory, which is linked to its final name once complete, so the
+MTA never picks up partially written files. File names are unique per backend
+instance and existing files are never overwritten.
+
+Messages are handed over one at a time, since each message is a separate file
+(or sendmail invocation) anyway and a failed message must not affect the
+others. The message log entries of the recipients are claimed and written in
+batches by the mailer (see Message._send_emails).
+"""
+
+import itertools
+import os
+import socket
+import subprocess
+import time
+import uuid
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.base import BaseEmailBackend
+
+
+class SpoolEmailBackend( BaseEmailBackend ):
+    """
+    Email backend writing messages to a spool directory or piping them to
+    sendmail.
+    """
+    def __init__( self, spool_dir=None, sendmail=None, fsync=None, fail_silently=False, **kwargs ):
+        super( SpoolEmailBackend, self ).__init__( fail_silently=fail_silently )
+        self.spool_dir = spool_dir or getattr( settings, 'MAILER_SPOOL_DIR', None )
+        self.sendmail = sendmail or getattr( settings, 'MAILER_SPOOL_SENDMAIL', None )
+        self.fsync = fsync if fsync is not None else getattr( settings, 'MAILER_SPOOL_FSYNC', False )
+
+        if not self.spool_dir and not self.sendmail:
+            raise ImproperlyConfigured( "MAILER_SPOOL_DIR or MAILER_SPOOL_SENDMAIL must be defined." )
+
+        self._prefix = '%d.%s.%d.%s' % ( int( time.time() ), socket.gethostname(), os.getpid(), uuid.uuid4().hex )
+        self._counter = itertools.count()
+
+    def send_messages( self, email_messages ):
+        if not email_messages:
+            return 0
+
+        sent = 0
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            try:
+                if self.spool_dir:
+                    self._write( message )
+                else:
+                    self._pipe( message )
+                message.relay = 'spool'
+                sent += 1
+            except Exception:
+                if not self.fail_silently:
+                    raise
+        return sent
+
+    def _write( self, message ):
+        """
+        Atomically write a message to the spool directory.
+        """
+        name = '%s.%d.eml' % ( self._prefix, next( self._counter ) )
+        tmp_path = os.path.join( self.spool_dir, '.%s.tmp' % name )
+
+        try:
+            with open( tmp_path, 'xb' ) as f:
+                f.write( message.message().as_bytes( linesep='\n' ) )
+                if self.fsync:
+                    f.flush()
+                    os.fsync( f.fileno() )
+            # Unlike rename, link fails if the file already exists.
+            os.link( tmp_path, os.path.join( self.spool_dir, name ) )
+            os.remove( tmp_path )
+        except Exception:
+            if os.path.exists( tmp_path ):
+                os.remove( tmp_path )
+            raise
+
+    def _pipe( self, message ):
+        """
+        Pipe a message to sendmail.
+        """
+        cmd = [self.sendmail, '-i', '-f', parseaddr( message.from_email )[1], '--'] + message.recipients()
+        p = subprocess.Popen( cmd, stdin=subprocess.PIPE )
+        p.communicate( message.message().as_bytes( linesep='\n' ) )
+        if p.returncode != 0:
+            raise IOError( "%s exited with status %s" % ( self.sendmail, p.returncode ) )
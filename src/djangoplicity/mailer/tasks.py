@@ -33,17 +33,21 @@
 from celery.task import task
 
 
-@task( ignore_result=True )
-def send_message( msg_id=None, test=True, emails=None ):
+@task( ignore_result=True, acks_late=True )
+def send_message( msg_id=None, test=True, emails=None, send_key=None ):
     """
-    Celery task to send a mass mailing message.
+    Celery task to send a mass mailing message. The task can safely be
+    redelivered or run by several workers - recipients are only sent to once
+    per send run (identified by send_key).
     """
     logger = send_message.get_logger()
 
     from djangoplicity.mailer.models import Message
     try:
         msg = Message.objects.get( pk=msg_id )
-        msg._send( test=test, emails=emails )
-        logger.info( "Message %s successfully sent." % msg_id )
+        if msg._send( test=test, emails=emails, send_key=send_key ):
+            logger.info( "Message %s successfully sent." % msg_id )
+        else:
+            logger.warning( "Message %s skipped - send run %s is not current." % ( msg_id, send_key ) )
     except Message.DoesNotExist:
         logger.error("Message %s does not exists." % msg_id)
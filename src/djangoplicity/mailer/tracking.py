@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-mailer
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Open and click tracking for HTML emails.
+
+Links in the HTML version of a message are rewritten once per send to point
+to the click tracking view, and a tracking pixel is added. For each recipient
+a signed token, identifying the recipient's message log entry, is inserted
+only in the rewritten URLs.
+
+Tracking hits are buffered in memory in each process and written in batches
+to the per-message (and per-link) counters, so a burst of hits right after a
+send only causes a few database updates.
+
+Tracking is enabled by defining the MAILER_TRACKING_URL setting with the
+absolute URL prefix of the site serving djangoplicity.mailer.urls (e.g.
+"https://www.example.org").
+"""
+
+import atexit
+import re
+import threading
+import time
+from html import unescape
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import F
+from django.urls import reverse
+
+# Placeholder used to split the tracking URLs where the token is inserted.
+TOKEN_PLACEHOLDER = 'mailer-token'
+
+TOKEN_SALT = 'djangoplicity.mailer.tracking'
+
+_HREF_RE = re.compile( r'''(<a\s[^>]*?href\s*=\s*)(["'])(https?://[^"']+)\2''', re.IGNORECASE )
+_BODY_END_RE = re.compile( r'</body\s*>', re.IGNORECASE )
+
+
+def get_tracking_url():
+    return getattr( settings, 'MAILER_TRACKING_URL', None )
+
+
+def make_token( msg_id, log_id ):
+    """
+    Make signed token identifying the message log entry of a recipient. The
+    token only contains ids, not the recipient's email address.
+    """
+    return signing.Signer( salt=TOKEN_SALT ).sign( '%d-%d' % ( msg_id, log_id ) )
+
+
+def parse_token( token ):
+    """
+    Get (message id, message log id) from a token. Raises
+    signing.BadSignature for invalid tokens.
+    """
+    msg_id, log_id = signing.Signer( salt=TOKEN_SALT ).unsign( token ).split( '-' )
+    return int( msg_id ), int( log_id )
+
+
+def _get_url( match ):
+    # Attribute values may contain HTML entities (e.g. "&amp;" between query
+    # parameters).
+    return unescape( match.group( 3 ) )
+
+
+def create_links( message, html ):
+    """
+    Create the tracked links of the HTML version of a message. Called once
+    when a send run is started, so the workers of the run (which may rewrite
+    the HTML concurrently) do not create duplicate links.
+    """
+    from djangoplicity.mailer.models import Link
+
+    existing = set( Link.objects.filter( message=message ).values_list( 'url', flat=True ) )
+    urls = set( [_get_url( m ) for m in _HREF_RE.finditer( html )] ) - existing
+    Link.objects.bulk_create( [Link( message=message, url=url ) for url in sorted( urls )] )
+
+
+def rewrite_html( message, html ):
+    """
+    Rewrite the links in the HTML version of a message to use the click
+    tracking view, and add the tracking pixel. Must only be called once per
+    send. Returns the list of HTML parts between which the recipient's token
+    must be inserted (i.e. ``token.join( parts )``), so the token is only
+    added to the rewritten URLs.
+
+    Links are normally created by create_links() when the send run is
+    started - missing links (e.g. if the HTML was changed since) are created
+    here.
+    """
+    from djangoplicity.mailer.models import Link
+
+    base_url = get_tracking_url().rstrip( '/' )
+    # The first link is used if there are duplicates.
+    links = dict( [( l.url, l ) for l in Link.objects.filter( message=message ).order_by( '-pk' )] )
+    # List of (start, end, replacement parts) of the original HTML
+    replacements = []
+
+    for m in _HREF_RE.finditer( html ):
+        url = _get_url( m )
+        if url not in links:
+            links[url] = Link.objects.create( message=message, url=url )
+        before, after = reverse( 'mailer_click', args=[TOKEN_PLACEHOLDER, links[url].pk] ).split( TOKEN_PLACEHOLDER )
+        replacements.append( ( m.start(), m.end(), [m.group( 1 ) + m.group( 2 ) + base_url + before, after + m.group( 2 )] ) )
+
+    before, after = reverse( 'mailer_open', args=[TOKEN_PLACEHOLDER] ).split( TOKEN_PLACEHOLDER )
+    pixel = ['<img src="%s%s' % ( base_url, before ), '%s" width="1" height="1" alt="" />' % after]
+    body_end = _BODY_END_RE.search( html )
+    position = body_end.start() if body_end else len( html )
+    replacements.append( ( position, position, pixel ) )
+    replacements.sort( key=lambda r: r[0] )
+
+    parts = ['']
+    last = 0
+    for start, end, ( before, after ) in replacements:
+        parts[-1] += html[last:start] + before
+        parts.append( after )
+        last = end
+    parts[-1] += html[last:]
+
+    return parts
+
+
+class EventBuffer( object ):
+    """
+    In-memory buffer of tracking hits, flushed to the database when the
+    buffer is full or the flush interval have passed.
+    """
+    def __init__( self, batch_size=100, interval=10 ):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.opens = {}
+        self.clicks = {}
+        self.size = 0
+        self.last_flush = time.time()
+
+    def add_open( self, msg_id ):
+        self._add( self.opens, msg_id )
+
+    def add_click( self, msg_id, link_id ):
+        self._add( self.clicks, ( msg_id, link_id ) )
+
+    def _add( self, counters, key ):
+        with self.lock:
+            counters[key] = counters.get( key, 0 ) + 1
+            self.size += 1
+            if self.size < self.batch_size and time.time() - self.last_flush < self.interval:
+                return
+            opens, clicks = self._swap()
+        self._write( opens, clicks )
+
+    def _swap( self ):
+        opens, clicks = self.opens, self.clicks
+        self.opens, self.clicks = {}, {}
+        self.size = 0
+        self.last_flush = time.time()
+        return opens, clicks
+
+    def flush( self ):
+        with self.lock:
+            opens, clicks = self._swap()
+        self._write( opens, clicks )
+
+    def _write( self, opens, clicks ):
+        if not opens and not clicks:
+            return
+
+        from djangoplicity.mailer.models import Link, Message
+
+        msg_clicks = {}
+        for ( msg_id, link_id ), n in clicks.items():
+            Link.objects.filter( pk=link_id, message_id=msg_id ).update( clicks=F( 'clicks' ) + n )
+            msg_clicks[msg_id] = msg_clicks.get( msg_id, 0 ) + n
+
+        for msg_id in set( opens.keys() ) | set( msg_clicks.keys() ):
+            Message.objects.filter( pk=msg_id ).update( opens=F( 'opens' ) + opens.get( msg_id, 0 ), clicks=F( 'clicks' ) + msg_clicks.get( msg_id, 0 ) )
+
+
+events = EventBuffer(
+    batch_size=getattr( settings, 'MAILER_TRACKING_BATCH_SIZE', 100 ),
+    interval=getattr( settings, 'MAILER_TRACKING_FLUSH_INTERVAL', 10 ),
+)
+atexit.register( events.flush )
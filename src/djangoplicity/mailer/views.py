@@ -29,3 +29,58 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 #
+
+"""
+Open and click tracking views (see djangoplicity.mailer.tracking).
+"""
+
+import base64
+
+from django.core import signing
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.views.decorators.cache import never_cache
+
+from djangoplicity.mailer.models import Link
+from djangoplicity.mailer.tracking import events, parse_token
+
+# Transparent 1x1 GIF
+PIXEL = base64.b64decode( 'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7' )
+
+# Cache of link id -> (message id, URL), links never change once created.
+_links = {}
+
+
+@never_cache
+def open_view( request, token=None ):
+    """
+    Tracking pixel - counts an open of the message.
+    """
+    try:
+        msg_id, _log_id = parse_token( token )
+        events.add_open( msg_id )
+    except ( signing.BadSignature, ValueError, TypeError ):
+        pass
+
+    return HttpResponse( PIXEL, content_type='image/gif' )
+
+
+@never_cache
+def click_view( request, token=None, link_id=None ):
+    """
+    Tracked link - counts a click and redirects to the link URL.
+    """
+    link_id = int( link_id )
+    if link_id not in _links:
+        link = get_object_or_404( Link, pk=link_id )
+        _links[link_id] = ( link.message_id, link.url )
+    msg_id, url = _links[link_id]
+
+    try:
+        token_msg_id, _log_id = parse_token( token )
+        if token_msg_id == msg_id:
+            events.add_click( msg_id, link_id )
+    except ( signing.BadSignature, ValueError, TypeError ):
+        pass
+
+    return HttpResponseRedirect( url )